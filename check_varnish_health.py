@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 
-import argparse
-import operator
+import ctypes
+import re
+import struct
 import nagiosplugin as nag
-from subprocess import Popen, PIPE
-from json import loads
 try:
-    from json import JSONDecodeError
+    from orjson import loads, JSONDecodeError
 except ImportError:
-    JSONDecodeError = ValueError
-from os.path import join, isdir
+    from json import loads, JSONDecodeError
+from os.path import join, dirname
 from os import makedirs
+import os
+from fcntl import flock, LOCK_EX
+from time import time
+from types import MappingProxyType
 import logging
 
 
@@ -38,44 +41,215 @@ WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWIS
 USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
+_LOGGER = logging.getLogger('nagiosplugin')
+# record in the state file used to compute growth rates: null padded metric name, little endian uint64
+STATE_RECORD = struct.Struct("<40sQ")
+# above this number of fields it's cheaper to dump all stats than to have varnishstat filter them via -f
+VARNISH_STAT_FILTER_THRESHOLD = 3
+# compiled regexes picking a set of fields from the output of varnishstat, see _load_varnishstats_json
+FIELD_PATTERNS = {}
+
+
+class VSCPoint(ctypes.Structure):
+    """
+    struct VSC_point as declared in vapi/vsc.h of varnish 6
+    """
+    _fields_ = [("ptr", ctypes.POINTER(ctypes.c_uint64)),
+                ("name", ctypes.c_char_p),
+                ("ctype", ctypes.c_char_p),
+                ("semantics", ctypes.c_int),
+                ("format", ctypes.c_int),
+                ("level", ctypes.c_void_p),
+                ("sdesc", ctypes.c_char_p),
+                ("ldesc", ctypes.c_char_p),
+                ("priv", ctypes.c_void_p)]
+
+
+VSC_ITER_F = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(VSCPoint))
+
+
+class VarnishApi(object):
+    """
+    Reads counters straight from the shared memory of the varnish daemon via libvarnishapi,
+    which saves forking varnishstat and passing its stats through json.
+    """
+    __slots__ = ("varnish_instance_name", "timeout", "lib")
+    library_name = "libvarnishapi.so.2"
+
+    def __init__(self, varnish_instance_name=None, timeout=3):
+        self.varnish_instance_name = varnish_instance_name
+        self.timeout = timeout
+        self.lib = self._load_library()
+
+    def _load_library(self):
+        try:
+            lib = ctypes.CDLL(self.library_name)
+        except OSError:
+            # find_library forks ldconfig, only pay for it if the soname of varnish 6 isn't found
+            from ctypes.util import find_library
+            library_path = find_library("varnishapi")
+            if library_path is None:
+                return None
+            try:
+                lib = ctypes.CDLL(library_path)
+            except OSError:
+                return None
+        try:
+            lib.VSM_New.restype = ctypes.c_void_p
+            lib.VSM_Arg.argtypes = [ctypes.c_void_p, ctypes.c_char, ctypes.c_char_p]
+            lib.VSM_Attach.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            lib.VSM_Error.argtypes = [ctypes.c_void_p]
+            lib.VSM_Error.restype = ctypes.c_char_p
+            lib.VSM_Destroy.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+            lib.VSC_New.restype = ctypes.c_void_p
+            lib.VSC_Arg.argtypes = [ctypes.c_void_p, ctypes.c_char, ctypes.c_char_p]
+            lib.VSC_Iter.argtypes = [ctypes.c_void_p, ctypes.c_void_p, VSC_ITER_F, ctypes.c_void_p]
+            lib.VSC_Destroy.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p]
+        except AttributeError:
+            # libvarnishapi of varnish < 6 (e.g. libvarnishapi.so.1) lacks these symbols, use varnishstat instead
+            return None
+        return lib
+
+    @property
+    def available(self):
+        return self.lib is not None
+
+    def fetch(self, fieldlist):
+        """
+        returns dict with varnish fields (e.g. MAIN.backend_fail) and their corresponding values
+        :param fieldlist: list or frozenset of strings of varnish stat fields
+        :return: dict()
+        :raises RuntimeError: if the shared memory of varnish could not be attached to
+        """
+        fieldset = frozenset(fieldlist)
+        result_dict = {}
+
+        def collect_point(priv, point):
+            if point:
+                name = point.contents.name.decode()
+                if name in fieldset:
+                    result_dict[name] = point.contents.ptr[0]
+            return 0
+
+        vsm = ctypes.c_void_p(self.lib.VSM_New())
+        try:
+            if self.varnish_instance_name is not None:
+                self.lib.VSM_Arg(vsm, b"n", self.varnish_instance_name.encode())
+            self.lib.VSM_Arg(vsm, b"t", str(self.timeout).encode())
+            if self.lib.VSM_Attach(vsm, -1):
+                # varnishstat would wait on the same shared memory, report the error instead of falling back
+                raise RuntimeError("Failed to attach to varnish shared memory: {}".format(
+                    self.lib.VSM_Error(vsm).decode(errors="replace")))
+            vsc = ctypes.c_void_p(self.lib.VSC_New())
+            try:
+                # same as varnishstat -f, libvarnishapi then skips the callback into python for all other counters
+                for field in fieldset:
+                    self.lib.VSC_Arg(vsc, b"f", field.encode())
+                self.lib.VSC_Iter(vsc, vsm, VSC_ITER_F(collect_point), None)
+            finally:
+                self.lib.VSC_Destroy(ctypes.byref(vsc), vsm)
+        finally:
+            self.lib.VSM_Destroy(ctypes.byref(vsm))
+        return result_dict
+
 
 class CheckVarnishHealth(nag.Resource):
+    # nag.Resource has no __slots__, instances keep a __dict__ but the attributes below are stored in slots
+    __slots__ = ("_metric_fn", "metric", "varnishstat_utility_path", "varnish_instance_name", "_argv_prefix",
+                 "min", "max", "tmpdir", "stats_cache_ttl", "stats_cache_path", "statefile", "_tmpdir_ok",
+                 "legacy", "cookie_compat", "fieldlist", "_stats")
+    # always dump all counters instead of filtering via -f, even below VARNISH_STAT_FILTER_THRESHOLD fields.
+    # Stats are fetched once per execution anyway, this only moves the filtering from varnishstat to python
+    BATCH_ALL = False
+    # metrics reporting a single counter: name -> (varnish field, report growth since last execution)
+    SIMPLE_METRICS = {
+        # "The count of parseable client requests seen"
+        "client_good_request_rate": ("MAIN.client_req", True),
+        # objects passed straight to backend due to presence of a "hitforpass" object
+        "cache_hitforpass_rate": ("MAIN.cache_hitpass", True),
+        # objects expired in cache due to ttl
+        "cached_objects_expired_rate": ("MAIN.n_expired", True),
+        # objects that have been forcefully evicted from storage to make room for a new object
+        "cached_objects_nuked_rate": ("MAIN.n_lru_nuked", True),
+        # failed thread creation
+        "threads_failed_rate": ("MAIN.threads_failed", True),
+        # thread creation
+        "threads_creation_rate": ("MAIN.threads_created", True),
+        # failed thread creation limited by thread_pool_max
+        "threads_failed_at_limit_rate": ("MAIN.threads_limited", True),
+        # current length of session queue, limited by thread_queue_limit
+        "session_queue_rate": ("MAIN.thread_queue_len", False),
+        # requests made to backend
+        "backend_request_rate": ("MAIN.backend_req", True),
+        # requests made to backend that resulted in failure due to any cause (no 1XX,2XX or 3XX reponse)
+        "backend_failed_request_rate": ("MAIN.backend_req", True),
+        # connections opened to backend
+        "backend_connection_rate": ("MAIN.backend_conn", True),
+        # failed connections to backend due to saturation
+        "backend_connection_saturation_rate": ("MAIN.backend_busy", True),
+        # unattempted connections to backend due to it being marked as unhealthy by varnish
+        "backend_unattempted_connections_rate": ("MAIN.backend_unhealthy", True)
+    }
+    REQUIRED_FIELDS = {
+        "client_bad_request_rate": ["MAIN.client_req_400", "MAIN.client_req_411",
+                                    "MAIN.client_req_413", "MAIN.client_req_417"],
+        "cache_hitrate_pct": ["MAIN.cache_hit", "MAIN.cache_miss"]
+    }
+    REQUIRED_FIELDS.update({name: [field] for name, (field, growth) in SIMPLE_METRICS.items()})
 
     def __init__(self,
                  metric,
                  varnishstat_utility_path=None,
                  varnish_instance_name=None,
                  tmpdir=None,
+                 stats_cache_ttl=0,
+                 legacy=False,
+                 cookie_compat=False,
+                 fieldlist=None,
+                 shared_stats=None,
                  min=None,
                  max=None):
+        try:
+            self._metric_fn = self._METRIC_MAP[metric]
+        except KeyError:
+            raise ValueError("Metric \"{}\" not found. Use --help to check for metrics available.".format(metric))
         self.metric = metric
+        if varnishstat_utility_path is not None and not dirname(varnishstat_utility_path):
+            # a bare command name would keep subprocess from using posix_spawn, see _run_varnishstat
+            from shutil import which
+            varnishstat_utility_path = which(varnishstat_utility_path) or varnishstat_utility_path
         self.varnishstat_utility_path = varnishstat_utility_path
         self.varnish_instance_name = varnish_instance_name
+        self._argv_prefix = [self.varnishstat_utility_path, "-j", "-1"]
+        if self.varnish_instance_name is not None:
+            self._argv_prefix.extend(["-n", self.varnish_instance_name])
         self.min = min
         self.max = max
-        self.logger = logging.getLogger('nagiosplugin')
         self.tmpdir = join(tmpdir, self.varnish_instance_name if self.varnish_instance_name else "default")
+        self.stats_cache_ttl = stats_cache_ttl
+        self.stats_cache_path = join(self.tmpdir, "varnishstats.cache")
+        self.statefile = join(self.tmpdir, "state.bin")
+        self._tmpdir_ok = False
+        self.legacy = legacy
+        self.cookie_compat = cookie_compat
+        self.fieldlist = fieldlist if fieldlist is not None else self.REQUIRED_FIELDS[metric]
+        self._stats = shared_stats if shared_stats is not None else {}
 
 
-    def client_good_request_rate(self):
+    @classmethod
+    def required_fields(cls, metrics):
         """
-        "The count of parseable client requests seen"
-        :return: change of metric since last execution and auxiliary information
+        :param metrics: list of metric names
+        :return: sorted list of the varnish stat fields needed to compute all of the metrics
         """
-        current_value = sum(self._fetch_varnishstats(["MAIN.client_req"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "client_good_request_rate",
-            "uom": "c",
-            "min": 0}
+        return sorted({field for metric in metrics for field in cls.REQUIRED_FIELDS[metric]})
 
     def client_bad_request_rate(self):
         """
         Client requests received, subject to 400,411,413,417 errors
         :return: change of metric since last execution and auxiliary information
         """
-        required_metrics = ["MAIN.client_req_400", "MAIN.client_req_411", "MAIN.client_req_413", "MAIN.client_req_417"]
-        current_value = sum([val for val in self._fetch_varnishstats(required_metrics).values()])
+        current_value = sum(self._stats.get(field, 0) for field in self.REQUIRED_FIELDS["client_bad_request_rate"])
         return {
             "value": self._get_growth_rate(current_value),
             "name": "client_bad_request_rate",
@@ -87,251 +261,236 @@ class CheckVarnishHealth(nag.Resource):
         get cache hitrate as percentage
         :return: current cache hitrate and auxiliary information
         """
-        required_metrics = ["MAIN.cache_hit", "MAIN.cache_miss"]
-        metrics_dict = self._fetch_varnishstats(required_metrics)
         return {
-            "value": self._get_percentage(metrics_dict["MAIN.cache_hit"],
-                                          metrics_dict["MAIN.cache_hit"] + metrics_dict["MAIN.cache_miss"]),
+            "value": self._get_percentage(self._stats["MAIN.cache_hit"],
+                                          self._stats["MAIN.cache_hit"] + self._stats["MAIN.cache_miss"]),
             "name": "cache_hitrate_pct",
             "uom": "%",
             "min": 0,
             "max": 100}
 
-    def cache_hitforpass_rate(self):
-        """
-        rate of objects passed straight to backend due to presence of a "hitforpass" object
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.cache_hitpass"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "cache_hitforpass_rate",
-            "uom": "c",
-            "min": 0}
-
-    def cached_objects_expired_rate(self):
-        """
-        rate of objects expired in cache due to ttl
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.n_expired"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "cached_objects_expired_rate",
-            "uom": "c",
-            "min": 0}
-
-    def cached_objects_nuked_rate(self):
-        """
-        rate of objects that have been forcefully evicted from storage to make room for a new object.
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.n_lru_nuked"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "cached_objects_nuked_rate",
-            "uom": "c",
-            "min": 0}
-
-    def threads_failed_rate(self):
-        """
-        rate of failed thread creation
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.threads_failed"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "threads_failed_rate",
-            "uom": "c",
-            "min": 0}
-
-    def threads_creation_rate(self):
-        """
-        rate of thread creation
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.threads_created"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "threads_creation_rate",
-            "uom": "c",
-            "min": 0}
-
-    def threads_failed_at_limit_rate(self):
-        """
-        rate of failed thread creation limited by thread_pool_max
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.threads_limited"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "threads_failed_at_limit_rate",
-            "uom": "c",
-            "min": 0}
-
-    def session_queue_rate(self):
+    def _simple_metric(self):
         """
-        current length of session queue, limited by thread_queue_limit
-        :return: change of metric since last execution and auxiliary information
+        report the counter configured for the metric in SIMPLE_METRICS
+        :return: current value or change of metric since last execution and auxiliary information
         """
-        current_value = sum(self._fetch_varnishstats(["MAIN.thread_queue_len"]).values())
+        field, growth = self.SIMPLE_METRICS[self.metric]
+        # like varnishstat, count a counter missing from this varnish version as 0
+        current_value = self._stats.get(field, 0)
         return {
-            "value": current_value,
-            "name": "session_queue_rate",
+            "value": self._get_growth_rate(current_value) if growth else current_value,
+            "name": self.metric,
             "uom": "c",
             "min": 0}
 
-    def backend_request_rate(self):
-        """
-        rate of requests made to backend
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.backend_req"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "backend_request_rate",
-            "uom": "c",
-            "min": 0}
-
-    def backend_failed_request_rate(self):
-        """
-        rate of requests made to backend that resulted in failure due to any cause (no 1XX,2XX or 3XX reponse)
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.backend_req"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "backend_failed_request_rate",
-            "uom": "c",
-            "min": 0}
+    _METRIC_MAP = {
+        "client_bad_request_rate": client_bad_request_rate,
+        "cache_hitrate_pct": cache_hitrate_pct
+    }
+    _METRIC_MAP.update(dict.fromkeys(SIMPLE_METRICS, _simple_metric))
 
-    def backend_connection_rate(self):
-        """
-        rate of connections opened to backend
-        :return: change of metric since last execution and auxiliary information
-        """
-        current_value = sum(self._fetch_varnishstats(["MAIN.backend_conn"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "backend_connection_rate",
-            "uom": "c",
-            "min": 0}
+    def _create_tmp_dir(self):
+        if self._tmpdir_ok:
+            return
+        try:
+            makedirs(self.tmpdir, mode=0o750, exist_ok=True)
+        except PermissionError:
+            _LOGGER.error("Failed to create tmpdir %s", self.tmpdir)
+            raise
+        self._tmpdir_ok = True
 
-    def backend_connection_saturation_rate(self):
+    def _atomic_write(self, path, data):
         """
-        rate of failed connections to backend due to saturation
-        :return: change of metric since last execution and auxiliary information
+        Atomically replace the file at path, concurrent executions of the plugin
+        will either see the old or the new content but never a partially written one.
+        :param path: file to replace, must reside in tmpdir
+        :param data: bytes
         """
-        current_value = sum(self._fetch_varnishstats(["MAIN.backend_busy"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "backend_connection_saturation_rate",
-            "uom": "c",
-            "min": 0}
+        # tempfile pulls in random and shutil, most executions (e.g. percentages or a warm stats cache) don't need it
+        from tempfile import mkstemp
+        fd, tmp_path = mkstemp(dir=self.tmpdir, prefix=".tmp.")
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, path)
 
-    def backend_unattempted_connections_rate(self):
+    def _swap_prev(self, value):
         """
-        rate of unattempted connections to backend due to it being marked as unhealthy by varnish
-        :return: change of metric since last execution and auxiliary information
+        Replace the value saved for the metric in the state file shared by all metrics. The file is locked
+        while doing so, concurrent executions of the plugin therefor never lose an update.
+        :param value: value to save for the next execution
+        :return: value saved by the last execution or None
         """
-        current_value = sum(self._fetch_varnishstats(["MAIN.backend_unhealthy"]).values())
-        return {
-            "value": self._get_growth_rate(current_value),
-            "name": "backend_unattempted_connections_rate",
-            "uom": "c",
-            "min": 0}
-
-    def _create_tmp_dir(self):
-        if not isdir(self.tmpdir):
-            try:
-                makedirs(self.tmpdir, mode=0o750)
-            except PermissionError:
-                self.logger.error("Failed to create tmpdir {}".format(self.tmpdir))
-                raise
+        key = self.metric.encode()
+        fd = os.open(self.statefile, os.O_RDWR | os.O_CREAT, 0o640)
+        try:
+            flock(fd, LOCK_EX)
+            state = os.read(fd, os.fstat(fd).st_size)
+            for offset in range(0, len(state) - STATE_RECORD.size + 1, STATE_RECORD.size):
+                name, historic_value = STATE_RECORD.unpack_from(state, offset)
+                if name.rstrip(b"\0") == key:
+                    break
+            else:
+                offset = len(state) - len(state) % STATE_RECORD.size
+                historic_value = None
+            os.pwrite(fd, STATE_RECORD.pack(key, value), offset)
+        finally:
+            os.close(fd)
+        return historic_value
 
     def _get_growth_rate(self, current_value):
         """
         Varnishstat often reports cummulative values for its metrics. As were only interested in relative changes
-        we need to save state between executions of the plugin (done via nagiosplugin.Cookie). The first execution
+        we need to save state between executions of the plugin (done via one binary state file holding a fixed size
+        record per metric, or via nagiosplugin.Cookie if cookie_compat is set). The first execution
         will therefor only ever report 0 and save state.
         :param current_value: value read from varnishstat from this execution
         :return: change in value since last execution
         """
         self._create_tmp_dir()
 
-        with nag.Cookie(statefile=join(self.tmpdir,self.metric)) as cookie:
-            historic_value = cookie.get(self.metric)
-            if historic_value is not None:
-                metric_value = current_value - historic_value
-                cookie[self.metric] = current_value
-                cookie.commit()
-            else:
-                metric_value = 0
+        if self.cookie_compat:
+            with nag.Cookie(statefile=join(self.tmpdir,self.metric)) as cookie:
+                historic_value = cookie.get(self.metric)
                 cookie[self.metric] = current_value
                 cookie.commit()
-        return metric_value
+            return current_value - historic_value if historic_value is not None else 0
+
+        historic_value = self._swap_prev(current_value)
+        if historic_value is None:
+            return 0
+        return current_value - historic_value
 
     def _get_percentage(self, part, total):
-        try:
-            part = sum(part)
-        except TypeError:
-            pass
-        try:
-            total = sum(total)
-        except TypeError:
-            pass
-        try:
-            ret_val = round(part / total * 100, 2)
-        except ZeroDivisionError:
-            ret_val = 0
-        return ret_val
+        return round(part / total * 100, 2) if total else 0
 
-    def _load_varnishstats_json(self, varnish_output, fieldlist):
+    def _load_varnishstats_json(self, varnish_output, fieldset):
         """
         returns dict with varnish fields (e.g. MGT.child_died) and their corresponding values
-        :param varnish_output: string, must be valid json
-        :param fieldlist: list of strings of varnish stat fields (e.g. ["MAIN.backend_fail"])
+        the requested fields are picked from the output by regex, decoding the whole json document
+        is only done if this fails (e.g. due to a change in output format of varnishstat)
+        :param varnish_output: bytes, must be valid json
+        :param fieldset: frozenset of strings of varnish stat fields (e.g. frozenset(["MAIN.backend_fail"]))
         :return: dict()
         """
+        field_pattern = FIELD_PATTERNS.get(fieldset)
+        if field_pattern is None:
+            field_pattern = re.compile(rb'"(' + b"|".join(re.escape(field.encode()) for field in fieldset) +
+                                       rb')"\s*:\s*\{[^}]*?"value"\s*:\s*(-?\d+)')
+            FIELD_PATTERNS[fieldset] = field_pattern
+        if len(fieldset) == 1:
+            match = field_pattern.search(varnish_output)
+            matched_dict = {match.group(1).decode(): int(match.group(2))} if match else {}
+        else:
+            matched_dict = {match.group(1).decode(): int(match.group(2))
+                            for match in field_pattern.finditer(varnish_output)}
+        if len(matched_dict) == len(fieldset):
+            return matched_dict
+        _LOGGER.debug("Failed to match all fields in varnish output, falling back to full json decoding")
         try:
             result_dict = loads(varnish_output)
         except JSONDecodeError:
-            self.logger.error("Failed to decode json for fields {} from varnish output: {}".format(
-                ", ".join(fieldlist),
-                varnish_output))
+            _LOGGER.error("Failed to decode json for fields %s from varnish output: %s",
+                          ", ".join(fieldset),
+                          varnish_output.decode(errors="replace"))
             raise
-        return {field: value["value"] for (field, value) in result_dict.items() if field in fieldlist}
+        return {field: result_dict[field]["value"] for field in fieldset if field in result_dict}
+
+    def _read_stats_cache(self):
+        """
+        Return the varnishstat output cached by a previous execution of the plugin,
+        as long as it is younger than stats_cache_ttl seconds.
+        :return: bytes or None if there is no valid cache
+        """
+        try:
+            if os.stat(self.stats_cache_path).st_mtime < time() - self.stats_cache_ttl:
+                return None
+            with open(self.stats_cache_path, "rb") as cache_file:
+                return cache_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _refresh_stats_cache(self):
+        """
+        Run varnishstat and replace the cached output. Executions of the plugin starting at the same time
+        wait on a lock file, the first one runs varnishstat and the others reuse its output.
+        :return: bytes, raw output of varnishstat
+        """
+        self._create_tmp_dir()
+        fd = os.open(self.stats_cache_path + ".lock", os.O_RDWR | os.O_CREAT, 0o640)
+        try:
+            flock(fd, LOCK_EX)
+            varnish_output = self._read_stats_cache()
+            if varnish_output is None:
+                varnish_output = self._run_varnishstat()
+                self._atomic_write(self.stats_cache_path, varnish_output)
+        finally:
+            os.close(fd)
+        return varnish_output
+
+    def _run_varnishstat(self, fieldlist=()):
+        """
+        Start varnishstat and return its raw output
+        :param fieldlist: list of strings of varnish stat fields, empty to fetch all fields
+        :return: bytes
+        """
+        arglist = self._argv_prefix.copy()
+        for field in fieldlist:
+            arglist.extend(("-f", field))
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Starting %s with args %s", arglist[0], " ".join(arglist[1:]))
+        # subprocess starts the child via posix_spawn instead of forking the interpreter as long as the
+        # executable has a directory component and close_fds, pass_fds and preexec_fn are not used.
+        # Descriptors opened by python are non-inheritable, but inheritable ones passed down by the
+        # nagios/icinga parent process are no longer closed and leak into varnishstat with close_fds=False.
+        # subprocess is only needed if libvarnishapi is not used, importing it costs several ms
+        from subprocess import run, PIPE, TimeoutExpired
+        try:
+            completed_process = run(arglist, stdout=PIPE, bufsize=-1, close_fds=False, timeout=3)
+        except TimeoutExpired:
+            _LOGGER.error("varnishstat ran into timeout, aborting.")
+            raise
+        if completed_process.returncode:
+            raise RuntimeError("{} exited with status {}".format(arglist[0], completed_process.returncode))
+        return completed_process.stdout
 
     def _fetch_varnishstats(self, fieldlist):
         """
-        Grab raw stats from varnish daemon
+        Grab raw stats from varnish daemon, preferably through libvarnishapi. When using varnishstat
+        (legacy or libvarnishapi not available) only the fields requested are fetched via -f, unless more than
+        VARNISH_STAT_FILTER_THRESHOLD fields are requested or BATCH_ALL or stats_cache_ttl is set. In that case
+        all fields are read from the complete output of varnishstat. If stats_cache_ttl
+        is set, the output is additionally cached in tmpdir and shared between executions of the plugin
+        (even for different metrics).
         :param fieldlist: list of strings of varnish stat fields
         :return: dict()
         """
-        extended_fieldlist = [("-f", field) for field in fieldlist]
-        arglist = [self.varnishstat_utility_path, "-j", "-1"]
-        if self.varnish_instance_name is not None:
-            arglist.extend(["-n",self.varnish_instance_name])
-        arglist.extend([arg for pair in extended_fieldlist for arg in pair])
-        self.logger.debug("Starting {} with args {}".format(arglist[0], " ".join(arglist[1:])))
-        process = Popen(arglist, stdout=PIPE)
-        stdout, stderr = process.communicate()
-        stdout_string = stdout.decode()
-        try:
-            exit_status = process.wait(timeout=3)
-        except TimeoutError:
-            self.logger.error("varnishstat ran into timeout, aborting.")
-            raise
-        return self._load_varnishstats_json(stdout_string, fieldlist)
+        fieldset = frozenset(fieldlist)
+        if not self.legacy:
+            varnish_api = VarnishApi(self.varnish_instance_name)
+            if varnish_api.available:
+                return varnish_api.fetch(fieldset)
+            _LOGGER.info("No usable libvarnishapi found, falling back to %s", self.varnishstat_utility_path)
+        if self.stats_cache_ttl <= 0:
+            if self.BATCH_ALL or len(fieldset) > VARNISH_STAT_FILTER_THRESHOLD:
+                return self._load_varnishstats_json(self._run_varnishstat(), fieldset)
+            return self._load_varnishstats_json(self._run_varnishstat(fieldlist), fieldset)
+        varnish_output = self._read_stats_cache()
+        if varnish_output is None:
+            _LOGGER.debug("No valid cache found at %s", self.stats_cache_path)
+            varnish_output = self._refresh_stats_cache()
+        return self._load_varnishstats_json(varnish_output, fieldset)
 
     def probe(self):
         """
         method required by nagiosplugin, used to start gathering metrics
-        in this case a method with the same name as the metric (e.g. backend_request_rate()) gets called
+        in this case the method registered for the metric in _METRIC_MAP (e.g. cache_hitrate_pct()) gets called
+        the stats are only fetched if no other resource sharing the same shared_stats dict did so already
         :return: result of metric gathering and auxiliary information
         """
-        self.logger.info("Starting fetch of stats for metric {}".format(self.metric))
-        metric_dict = operator.methodcaller(self.metric)(self)
+        _LOGGER.info("Starting fetch of stats for metric %s", self.metric)
+        if not self._stats:
+            self._stats.update(self._fetch_varnishstats(self.fieldlist))
+        metric_dict = self._metric_fn(self)
         if self.min:
             metric_dict["min"] = self.min
         if self.max:
@@ -345,35 +504,50 @@ class CheckVarnishHealth(nag.Resource):
 
 
 class CheckVarnishHealthContext(nag.ScalarContext):
+    # nagiosplugin calls fmt_metric(metric, context) if it is callable, saving the parse of a format string per result
     fmt_helper = {
-        "client_good_request_rate": "{value} client request(s) not subject to 4XX response",
-        "client_bad_request_rate": "{value} client request(s) subject to 4XX response",
-        "cache_hitrate_pct": "{value}{uom} of requests satisfied by cache",
-        "cache_hitforpass_rate": "{value} request(s) marked hit for pass",
-        "cached_objects_expired_rate": "{value} object(s) expired due to ttl",
-        "cached_objects_nuked_rate": "{value} object(s) nuked from cache due to saturation",
-        "threads_creation_rate": "{value} thread(s) created",
-        "threads_failed_rate": "failed to create {value} thread(s)",
-        "threads_failed_at_limit_rate": "failed to create {value} thread(s) because of configured limit",
-        "session_queue_rate": "{value} session(s) waiting for a worker thread",
-        "backend_request_rate": "{value} backend request(s) sent",
-        "backend_failed_request_rate": "{value} failed backend request(s)",
-        "backend_connection_rate": "{value} backend connection(s) initiated",
-        "backend_connection_saturation_rate": "max backend connections reached for {value} time(s)",
-        "backend_unattempted_connections_rate": "{value} connection(s) to backend not attempted due to unhealthy status"
+        "client_good_request_rate":
+            lambda metric, context: f"{metric.value} client request(s) not subject to 4XX response",
+        "client_bad_request_rate":
+            lambda metric, context: f"{metric.value} client request(s) subject to 4XX response",
+        "cache_hitrate_pct":
+            lambda metric, context: f"{metric.value}{metric.uom} of requests satisfied by cache",
+        "cache_hitforpass_rate":
+            lambda metric, context: f"{metric.value} request(s) marked hit for pass",
+        "cached_objects_expired_rate":
+            lambda metric, context: f"{metric.value} object(s) expired due to ttl",
+        "cached_objects_nuked_rate":
+            lambda metric, context: f"{metric.value} object(s) nuked from cache due to saturation",
+        "threads_creation_rate":
+            lambda metric, context: f"{metric.value} thread(s) created",
+        "threads_failed_rate":
+            lambda metric, context: f"failed to create {metric.value} thread(s)",
+        "threads_failed_at_limit_rate":
+            lambda metric, context: f"failed to create {metric.value} thread(s) because of configured limit",
+        "session_queue_rate":
+            lambda metric, context: f"{metric.value} session(s) waiting for a worker thread",
+        "backend_request_rate":
+            lambda metric, context: f"{metric.value} backend request(s) sent",
+        "backend_failed_request_rate":
+            lambda metric, context: f"{metric.value} failed backend request(s)",
+        "backend_connection_rate":
+            lambda metric, context: f"{metric.value} backend connection(s) initiated",
+        "backend_connection_saturation_rate":
+            lambda metric, context: f"max backend connections reached for {metric.value} time(s)",
+        "backend_unattempted_connections_rate":
+            lambda metric, context: f"{metric.value} connection(s) to backend not attempted due to unhealthy status"
     }
+    _HELP = ", ".join(fmt_helper)
+    fmt_helper = MappingProxyType(fmt_helper)
 
     def __init__(self, name, warning=None, critical=None,
                  fmt_metric='{name} is {valueunit}', result_cls=nag.Result):
 
-        try:
-            metric_helper_text = CheckVarnishHealthContext.fmt_helper[name]
-        except KeyError:
-            raise ValueError("Metric \"{}\" not found. Use --help to check for metrics available.".format(name))
+        metric_formatter = CheckVarnishHealthContext.fmt_helper[name]
         super(CheckVarnishHealthContext, self).__init__(name,
                                                         warning=warning,
                                                         critical=critical,
-                                                        fmt_metric=metric_helper_text,
+                                                        fmt_metric=metric_formatter,
                                                         result_cls=result_cls)
 
 
@@ -395,6 +569,7 @@ class CheckVarnishHealthSummary(nag.Summary):
 
 
 def parse_arguments():
+    import argparse
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-w', '--warning', metavar='RANGE', default='',
                         help='return warning if load is outside RANGE,\
@@ -407,13 +582,20 @@ def parse_arguments():
     parser.add_argument('-n', '--varnish-instance-name', action='store', help='hostname by default')
     parser.add_argument('-t', '--tmpdir', action='store', default='/tmp/check_varnish_health',
                         help='path to directory to store delta files')
+    parser.add_argument('--stats-cache-ttl', action='store', type=int, default=0,
+                        help='seconds to reuse the output of varnishstat across checks, 0 disables caching')
+    parser.add_argument('--legacy', action='store_true', default=False,
+                        help='always use the varnishstat utility instead of reading stats via libvarnishapi')
+    parser.add_argument('--cookie-compat', action='store_true', default=False,
+                        help='save state in json files via nagiosplugin.Cookie as done by older versions')
     parser.add_argument('--max', action='store', default=None,
                         help='maximum value for performance data')
     parser.add_argument('--min', action='store', default=None,
                         help='minimum value for performance data')
-    parser.add_argument('--metric', action='store', required=True,
-                        help='Supported keywords: {}'.format(
-                            ", ".join(CheckVarnishHealthContext.fmt_helper.keys())))
+    parser.add_argument('--metric', action='store', required=True, metavar='METRIC', nargs='+',
+                        choices=tuple(CheckVarnishHealthContext.fmt_helper),
+                        help='one or more metrics to check, thresholds apply to each of them. '
+                             'Supported keywords: ' + CheckVarnishHealthContext._HELP)
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='increase output verbosity (use up to 2 times)')
 
@@ -423,17 +605,25 @@ def parse_arguments():
 @nag.guarded
 def main():
     args = parse_arguments()
-    check = nag.Check(
-        CheckVarnishHealth(
-            args.metric,
-            varnishstat_utility_path=args.varnishstat_utility_path,
-            varnish_instance_name=args.varnish_instance_name,
-            tmpdir=args.tmpdir,
-            min=args.min,
-            max=args.max),
-        CheckVarnishHealthContext(args.metric, warning=args.warning, critical=args.critical),
-        CheckVarnishHealthSummary()
-    )
+    # a metric given twice would read back the state its first copy just saved
+    metrics = list(dict.fromkeys(args.metric))
+    fieldlist = CheckVarnishHealth.required_fields(metrics)
+    shared_stats = {}
+    check = nag.Check(CheckVarnishHealthSummary())
+    for metric in metrics:
+        check.add(CheckVarnishHealth(
+                      metric,
+                      varnishstat_utility_path=args.varnishstat_utility_path,
+                      varnish_instance_name=args.varnish_instance_name,
+                      tmpdir=args.tmpdir,
+                      stats_cache_ttl=args.stats_cache_ttl,
+                      legacy=args.legacy,
+                      cookie_compat=args.cookie_compat,
+                      fieldlist=fieldlist,
+                      shared_stats=shared_stats,
+                      min=args.min,
+                      max=args.max),
+                  CheckVarnishHealthContext(metric, warning=args.warning, critical=args.critical))
     check.main(verbose=args.verbose)
 
 